@@ -1,20 +1,55 @@
+import atexit
 import logging
-from time import sleep
+import re
+import queue
+import threading
+from time import monotonic, sleep
 import pyvisa
 
+_log = logging.getLogger(__name__)
 
-def scan_visa(backend: str = "@py", resource_filter: str = "USB") -> list[str]:
-    rm = pyvisa.ResourceManager(backend)  # '@py' for pyvisa-py backend
-    # rm = pyvisa.ResourceManager()
-    resources = list()
-    logging.info(f"Scanning VISA devices...")
-    try:
-        resources = rm.list_resources(query=resource_filter)
-    except Exception as e:
-        print(f"Error listing resources: {e}")
-    finally:
-        rm.close()
-        return list(resources)
+RESOURCE_CACHE_TTL: float = 5.0  # Seconds a list_resources() result is reused for
+
+_resource_managers: dict[str, pyvisa.ResourceManager] = {}
+_resource_cache: dict[tuple[str, str], tuple[float, tuple[str, ...]]] = {}
+
+#  PROTOCOL::VENDOR_ID::PRODUCT_ID::SERIAL[::INTERFACE]::CLASS (INSTR, RAW, ...)
+_VISA_RE = re.compile(r'[A-Za-z]+\d*::(?P<vid>\d+)::(?P<pid>\d+)::(?P<sn>[^:]+)'
+                      r'(?:::(?P<iface>\d+))?::[A-Za-z]+')
+
+
+def _rm_singleton(backend: str = "@py") -> pyvisa.ResourceManager:
+    """Returns the process-wide ResourceManager for a backend, creating it on first use.
+    Opening one sets up a libusb context and enumerates devices, so it is kept alive."""
+    rm = _resource_managers.get(backend)
+    if rm is None:
+        rm = pyvisa.ResourceManager(backend)  # '@py' for pyvisa-py backend
+        _resource_managers[backend] = rm
+    return rm
+
+
+@atexit.register
+def _close_resource_managers():
+    """Closes the shared ResourceManagers once, at interpreter exit. Safe to call again."""
+    _resource_cache.clear()  # Listings came from the managers being closed
+    for rm in _resource_managers.values():
+        try:
+            rm.close()
+        except Exception as e:
+            _log.error("Error closing resource manager: %s", e)
+    _resource_managers.clear()
+
+
+def scan_visa(backend: str = "@py", resource_filter: str = "USB") -> tuple[str, ...]:
+    cached = _resource_cache.get((backend, resource_filter))
+    if cached and monotonic() - cached[0] < RESOURCE_CACHE_TTL:
+        return cached[1]
+    rm = _rm_singleton(backend)
+    _log.info("Scanning VISA devices...")
+    # Errors propagate, so callers can tell a failed scan from no devices attached
+    resources = tuple(rm.list_resources(query=resource_filter))  # Already a tuple, no copy
+    _resource_cache[(backend, resource_filter)] = (monotonic(), resources)
+    return resources
 
 
 class Device:
@@ -23,8 +58,7 @@ class Device:
 
     def __init__(self, resource_name: str):
         self.resource_name = resource_name
-        self.parts = self.resource_name.split('::')
-        self.Protocol = self.parts[0]
+        self.Protocol = resource_name.partition('::')[0]
 
     def res(self) -> str:
         return self.resource_name
@@ -33,15 +67,17 @@ class Device:
 class USB_Device(Device):
     def __init__(self, resource_name: str):
         super().__init__(resource_name)
-        try:
-            self.VendorID = int(self.parts[1])
-            self.ProductID = int(self.parts[2])
-            self.SN = self.parts[3]
-            self.InterfaceID = int(self.parts[4]) if len(self.parts) == 6 else 0
-        except ValueError:
-            print(f"Error: Could not parse numeric IDs from '{resource_name}'")
+        match = _VISA_RE.fullmatch(resource_name)
+        if match:
+            self.VendorID = int(match['vid'])
+            self.ProductID = int(match['pid'])
+            self.SN = match['sn']
+            self.InterfaceID = int(match['iface'] or 0)
+        else:
+            _log.error("Could not parse numeric IDs from '%s'", resource_name)
             self.VendorID = None
             self.ProductID = None
+            self.SN = None
             self.InterfaceID = None
 
     def set(self, protocol: str, vendor_id: int, product_id: int, sn: str, interface_id: int = 0):
@@ -78,15 +114,10 @@ class USB_Device(Device):
 
 
 def device_factory(resource_name: str) -> Device:
-    parts = resource_name.split("::")
-    if parts:
-        protocol = parts[0].lower()
-        if protocol.startswith("usb"):
-            return USB_Device(resource_name)
-        else:
-            return Device(resource_name)
-    else:
-        return Device(resource_name)
+    """Builds the Device subclass matching the resource name's protocol"""
+    if resource_name[:3].upper() == "USB":  # USB_Device does the parsing itself
+        return USB_Device(resource_name)
+    return Device(resource_name)
 
 
 class VISA_Connection:
@@ -94,19 +125,26 @@ class VISA_Connection:
 
     def __init__(self, visa_device: Device):
         self.visa_device = visa_device
-        self.resource_manager = pyvisa.ResourceManager('@py')  # Initialize here
+        self.resource_manager = _rm_singleton('@py')  # Shared, closed at interpreter exit
         self.instrument = None
+        #  Background writer, so SCPI writes can be in flight while the caller keeps going
+        self._write_queue: queue.Queue = queue.Queue(maxsize=4)
+        self._writer: threading.Thread | None = None
+        self._writer_error: Exception | None = None
 
     def __enter__(self):
-        print(f"Connecting to {self.visa_device.resource_name}...")
+        _log.info("Connecting to %s...", self.visa_device.resource_name)
 
         try:
             self.instrument = self.resource_manager.open_resource(self.visa_device.resource_name)
-            print(f"Successfully connected to: {self.instrument.resource_name}")
+            _log.info("Successfully connected to: %s", self.instrument.resource_name)
+            # Bound once for the write_bytes() hot path, keeping the resource's own terminator
+            self._write_raw = self.instrument.write_raw
+            self._termination = self.instrument.write_termination.encode(self.instrument.encoding)
 
             # Query the instrument's identification
             identification = self.instrument.query('*IDN?')
-            print(f"Instrument identification: {identification.strip()}")
+            _log.debug("Instrument identification: %s", identification.strip())
 
             # You can now send other commands to control the instrument
             # For example, to set the output to a sine wave at 1 kHz with 1 Vpp:
@@ -119,76 +157,180 @@ class VISA_Connection:
             return self  # Return self to allow use with 'as'
 
         except pyvisa.VisaIOError as e:
-            print(f"Error communicating with the instrument: {e}")
+            _log.error("Error communicating with the instrument: %s", e)
             self.__exit__(None, None, None)  # Ensure cleanup even on connect fail
             raise  # Re-raise the exception to stop execution
         except Exception as e:
-            print(f"An unexpected error occurred: {e}")
+            _log.error("An unexpected error occurred: %s", e)
             self.__exit__(None, None, None)
             raise
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         try:
+            self._stop_writer()
             if self.instrument:  # Check if instrument is valid
                 self.instrument.close()
-            if self.resource_manager:
-                self.resource_manager.close()
-            print("Instrument connection closed.")
+                self.instrument = None
+            _log.info("Instrument connection closed.")
         except Exception as e:
-            print(f"Error during cleanup: {e}")
+            _log.error("Error during cleanup: %s", e)
 
     def write(self, msg: str):
         if not self.instrument:
             raise ValueError("Instrument is not connected.")
-        self.instrument.write(msg)
-        logging.debug(f'Sending "{msg}"')
+        self.join()  # Keep ordering with any asynchronous writes still in flight
+        self._send(msg)
+
+    def write_bytes(self, payload: bytes):
+        """Sends pre-encoded SCPI via write_raw, skipping pyvisa's per-write encoding.
+        The write terminator is appended automatically."""
+        if not self.instrument:
+            raise ValueError("Instrument is not connected.")
+        self.join()
+        self._send(payload)
+
+    def write_async(self, msg: str | bytes):
+        """Queues a write on the background writer thread and returns immediately.
+        bytes are sent pre-encoded, as with write_bytes().
+        Blocks only if 4 writes are already in flight."""
+        if not self.instrument:
+            raise ValueError("Instrument is not connected.")
+        self._raise_writer_error()  # Fail at the next write, not only at the next join()
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_worker, name="VISA writer", daemon=True)
+            self._writer.start()
+        self._write_queue.put(msg)
+
+    def join(self):
+        """Waits for all asynchronous writes to be sent, re-raising any error they hit"""
+        if self._writer is not None:
+            self._write_queue.join()
+        self._raise_writer_error()
+
+    def _raise_writer_error(self):
+        if self._writer_error is not None:
+            error, self._writer_error = self._writer_error, None
+            raise error
+
+    def _send(self, msg: str | bytes):
+        if isinstance(msg, bytes):
+            self._write_raw(msg + self._termination)
+            if _log.isEnabledFor(logging.DEBUG):
+                _log.debug('Sending "%s"', msg.decode(errors='replace'))
+        else:
+            self.instrument.write(msg)
+            _log.debug('Sending "%s"', msg)
+
+    def _write_worker(self):
+        while True:
+            msg = self._write_queue.get()
+            try:
+                if msg is None:
+                    return
+                if self._writer_error is None:  # Drop writes queued behind a failure
+                    self._send(msg)
+            except Exception as e:
+                self._writer_error = e
+            finally:
+                self._write_queue.task_done()
+
+    def _stop_writer(self):
+        if self._writer is not None:
+            self._write_queue.put(None)
+            self._writer.join()
+            self._writer = None
+        if self._writer_error is not None:
+            _log.error("Unreported error from a background write: %s", self._writer_error)
+            self._writer_error = None
 
     def query(self, msg: str) -> str:
         if not self.instrument:
             raise ValueError("Instrument is not connected.")
-        logging.debug(f'Sending "{msg}"')
+        self.join()
+        _log.debug('Sending "%s"', msg)
         answer = str(self.instrument.query(msg))
-        logging.debug(f'Answer: "{answer.strip()}"')
+        _log.debug('Answer: "%s"', answer.strip())
         return answer
 
 
 class Function_Gen:
     """Responsible for tracking the state of the function generator"""
+    #  Pre-encoded commands for the per-note hot path
+    _OUTP_ON = b"OUTP1 ON"
+    _OUTP_OFF = b"OUTP1 OFF"
+    _QUIET_FREQ = 1  # Hz, what a soft stop parks the output at
 
     def __init__(self, visa_instance: VISA_Connection, vpp: float, offset: float, pulse_width: float):
         self.visa = visa_instance
+        self._pending: list[bytes] = []
         self.output: bool
-        self._set_outp(False, soft=False)
+        self._relay_on: bool | None = None  # Last OUTP1 state sent, None until the first one
+        self._sent_freq: int | None = None  # Last SOUR1:FREQ sent, None until the first one
+        self._freq_cmd_cache: dict[int, bytes] = {}  # Melodies reuse a handful of frequencies
+        self._set_outp(False, soft=False, flush=False)
         #  Frequency
         self.freq: int = 1000
-        self.configure_freq(self.freq)
+        self.configure_freq(self.freq, flush=False)
         #  Voltage
         self.volt: float = vpp
-        self.configure_vpp(self.volt)
+        self.configure_vpp(self.volt, flush=False)
         #  Pulse width
         self.width = pulse_width
-        self.configure_pulse_width(self.width)
+        self.configure_pulse_width(self.width, flush=False)
         #  Offset
         self.offset: float = offset
-        self.configure_offset(self.offset)
+        self.configure_offset(self.offset, flush=False)
+        self._flush()  # Whole setup goes out as one compound command
 
-        self.freq = int(float(self.visa.query("SOUR1:FREQ?")))
-        print(self.freq)
+        if _log.isEnabledFor(logging.DEBUG):
+            # Reading back what was just written costs a full round-trip, so only when debugging
+            _log.debug("Instrument frequency: %d", int(float(self.visa.query("SOUR1:FREQ?"))))
 
-    def configure_vpp(self, vpp: float):
-        self.visa.write(f"VOLT {vpp}")
+    def configure_vpp(self, vpp: float, flush: bool = True):
+        self._queue(f"VOLT {vpp}".encode(), flush)
 
-    def configure_offset(self, offset: float):
-        self.visa.write(f"VOLT:OFFS {offset}")
+    def configure_offset(self, offset: float, flush: bool = True):
+        self._queue(f"VOLT:OFFS {offset}".encode(), flush)
 
-    def configure_pulse_width(self, pulse_width: float):
-        # self.visa.write(f"FUNC:PULS:WIDT {pulse_width:.3e}")
-        self.visa.write(f"FUNC:PULS:WIDT {pulse_width}")
+    def configure_pulse_width(self, pulse_width: float, flush: bool = True):
+        # self._queue(f"FUNC:PULS:WIDT {pulse_width:.3e}".encode(), flush)
+        self._queue(f"FUNC:PULS:WIDT {pulse_width}".encode(), flush)
 
-    def configure_freq(self, freq:int):
-        self.visa.write(f'SOUR1:FREQ {freq}')
+    def configure_freq(self, freq: int, flush: bool = True):
+        self._queue_freq(freq)
+        if flush:
+            self._flush()
         self.freq = freq
-        # self.visa.write(f'SOUR1:FREQ {freq:.3e}')
+        # self._queue(f'SOUR1:FREQ {freq:.3e}'.encode(), flush)
+
+    def _queue(self, msg: bytes, flush: bool = True):
+        """Queues an SCPI command, optionally sending everything queued so far"""
+        self._pending.append(msg)
+        if flush:
+            self._flush()
+
+    def _queue_freq(self, freq: int):
+        """Queues a frequency change, unless the instrument is already at that frequency"""
+        if freq != self._sent_freq:
+            cmd = self._freq_cmd_cache.get(freq)
+            if cmd is None:
+                cmd = self._freq_cmd_cache[freq] = b'SOUR1:FREQ %d' % freq
+            self._queue(cmd, flush=False)
+            self._sent_freq = freq
+
+    def _flush(self, wait: bool = True):
+        """Sends all queued SCPI commands in a single write, to save USB round-trips
+
+        :param wait: Block until the write is sent, or hand it to the background writer?
+        :type wait:
+        """
+        if self._pending:
+            payload = b";:".join(self._pending)
+            if wait:
+                self.visa.write_bytes(payload)
+            else:
+                self.visa.write_async(payload)
+            self._pending = []
 
     def play_tone(self, freq: int, duration: float, stop: bool = True, wait: bool = True,
                   soft_stop: bool = True) -> None:
@@ -205,27 +347,46 @@ class Function_Gen:
         :param wait: Should the function wait the duration period or exit immediately? (Fire & Forget)
         :type wait:
         """
-        # self.visa.write(f"SOUR1:FREQ {freq}")
-        self.configure_freq(freq)
-        self._set_outp(True)
-        logging.debug(f"Setting freq to {freq}.")
+        self.begin_tone(freq)  # The duration starts counting while the write is in flight
         if wait:
-            sleep(duration)
             if stop:
-                self._set_outp(False, soft=soft_stop)
+                self.wait_and_stop(duration, soft=soft_stop)
+            else:
+                sleep(duration)
+
+    def begin_tone(self, freq: int):
+        """Starts a tone, returning as soon as the SCPI write is queued on the background writer"""
+        # Soft turn-on (re)applies self.freq, so frequency and output go out in one write
+        self.freq = freq
+        self._set_outp(True, flush=False)
+        self._flush(wait=False)
+        _log.debug("Setting freq to %d.", freq)
+
+    def end_tone(self, soft: bool = True):
+        """Stops the tone, returning as soon as the SCPI write is queued on the background writer"""
+        self._set_outp(False, soft=soft, flush=False)
+        self._flush(wait=False)
+
+    def wait_and_stop(self, duration: float, soft: bool = True):
+        """Lets the current tone play for duration seconds, then stops it"""
+        sleep(duration)
+        self._set_outp(False, soft=soft)  # Joins the outstanding write first
 
-    def _set_outp(self, output: bool, soft: bool = True):
+    def _set_outp(self, output: bool, soft: bool = True, flush: bool = True):
         if soft:
             # outp_v_msg = str(self.volt) if output else "0.1"
             # outp_o_msg = str(self.offset) if output else "0"
             # self.visa.write(f"VOLT {outp_v_msg}")
             # self.visa.write(f"VOLT:OFFS {outp_o_msg}")
-            outp_f_msg = str(self.freq) if output else "1"
-            self.visa.write(f'SOUR1:FREQ {outp_f_msg}')
-            self.visa.write("OUTP1 ON")
+            self._queue_freq(self.freq if output else self._QUIET_FREQ)
+            relay_on = True
         else:
-            outp_msg = "ON" if output else "OFF"
-            self.visa.write(f"OUTP1 {outp_msg}")
+            relay_on = output
+        if relay_on != self._relay_on:  # Usually already on between notes, so skip the OUTP1 write
+            self._queue(self._OUTP_ON if relay_on else self._OUTP_OFF, flush=False)
+            self._relay_on = relay_on
+        if flush:
+            self._flush()
         self.output = output
 
     def stop(self):
@@ -235,7 +396,7 @@ class Function_Gen:
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
     device_filter: str = "2391::9479"
-    logging.info(f'Device Filter: "{device_filter}"')
+    _log.info('Device Filter: "%s"', device_filter)
     # devices = scan_visa(resource_filter=device_filter)
     devices = scan_visa()
     if devices:
@@ -247,13 +408,13 @@ if __name__ == '__main__':
                 fg.play_tone(800, 0.8, soft_stop=False)
                 fg.stop()
         except Exception as e:
-            print(f"An error occurred during the main execution: {e}")
+            _log.error("An error occurred during the main execution: %s", e)
     else:
-        logging.warning("No devices matching the filter...")
+        _log.warning("No devices matching the filter...")
         devices = scan_visa()
         if devices:
-            logging.info(f"Available devices ({len(devices)}):")
+            _log.info("Available devices (%d):", len(devices))
             for device in devices:
-                logging.info(f"{device}")
+                _log.info("%s", device)
         else:
-            print("No available devices found")
+            _log.warning("No available devices found")
@@ -1,36 +1,113 @@
+import functools
+import itertools
 import logging
-from time import sleep
+import math
+import queue
+import threading
+from time import perf_counter, sleep
 
-import sounddevice as sd
 import numpy as np
-import mido
 
 import Function_gen as fg
 
+_log = logging.getLogger(__name__)
 
-def play_tone(frequency: int, duration: float, duty_cycle=0.05, volume=0.2, sample_rate=44100):
-    """Generates and plays a tone to the PC speakers
+# Semitone offset of each note name within an octave
+_NOTE_OFFSETS = {'C': 0,
+                 'C#': 1,
+                 'Db': 1,
+                 'D': 2,
+                 'D#': 3,
+                 'Eb': 3,
+                 'E': 4,
+                 'F': 5,
+                 'F#': 6,
+                 'Gb': 6,
+                 'G': 7,
+                 'G#': 8,
+                 'Ab': 8,
+                 'A': 9,
+                 'A#': 10,
+                 'Bb': 10,
+                 'B': 11}
 
-    TODO fix tone inconsistency"""
-    num_samples = int(duration * sample_rate)
-    period_samples = int(sample_rate / frequency)
-    high_samples = int(period_samples * duty_cycle)
-
-    tone = np.zeros(num_samples)  # Create an array of zeros with the correct length
-    for i in range(num_samples):
-        sample_index = i % period_samples
-        if sample_index < high_samples:
-            tone[i] = volume
-        else:
-            tone[i] = -volume
+# Seconds before the end of a note at which the next note's SCPI write is issued
+PIPELINE_SLACK: float = 0.002
+
+# Frequency of every MIDI note (0-127), rounded to the nearest Hz
+_MIDI_HZ = np.rint(2.0 ** ((np.arange(128) - 69) / 12.0) * 440.0).astype(np.int32)
+
+# Longest exact repeat render_tone caches and tiles, so the 64 cached templates hold at most 1 MB
+_MAX_TEMPLATE_SAMPLES = 4096
+
+# Sample buffer reused by play_tone between notes, sized for a 2 s note at 48 kHz
+_TONE_BUF = np.empty(2 * 48000, dtype=np.float32)
+
+
+def play_tone(frequency: float, duration: float, duty_cycle=0.05, volume=0.2, sample_rate=44100):
+    """Generates and plays a tone to the PC speakers"""
+    import sounddevice as sd  # Only the speaker paths need the audio stack
+
+    tone = _tone_buffer(int(duration * sample_rate))
+    render_tone(frequency, duration, duty_cycle, volume, sample_rate, out=tone)
 
     sd.play(tone, samplerate=sample_rate)
-    sd.wait()
+    sd.wait()  # Playback reads from the shared buffer, so it is only reusable after this
+
+
+def render_tone(frequency: float, duration: float, duty_cycle=0.05, volume=0.2, sample_rate=44100,
+                out: np.ndarray | None = None) -> np.ndarray:
+    """Generates a tone's float32 samples, into out if given (it must hold duration * sample_rate samples)"""
+    num_samples = int(duration * sample_rate)
+    tone = np.empty(num_samples, dtype=np.float32) if out is None else out
+
+    # The wave realigns with the sample grid every sample_rate / gcd(frequency, sample_rate) samples
+    repeat = sample_rate // math.gcd(int(frequency), sample_rate) if float(frequency).is_integer() else None
+    if repeat is None or repeat > _MAX_TEMPLATE_SAMPLES or repeat >= num_samples:
+        # No short exact repeat to tile, so computing the note directly is cheaper
+        _square_wave(frequency, duty_cycle, volume, sample_rate, out=tone)
+        return tone
+
+    # Tile one exact repeat of the wave into the buffer: a block copy, no per-sample math
+    template = _square_period(int(frequency), duty_cycle, volume, sample_rate)
+    repeats, tail = divmod(num_samples, template.size)
+    tone[:repeats * template.size].reshape(repeats, template.size)[:] = template
+    tone[repeats * template.size:] = template[:tail]
+    return tone
+
+
+def _square_wave(frequency: float, duty_cycle: float, volume: float, sample_rate: int, out: np.ndarray):
+    """Fills out with square wave samples, from continuous phase so the pitch stays exact
+    even when a period isn't a whole number of samples."""
+    phase = np.arange(out.size, dtype=np.float64)
+    phase *= frequency / sample_rate
+    np.remainder(phase, 1.0, out=phase)  # In place, no temporaries per ufunc
+    out.fill(-volume)
+    np.copyto(out, volume, where=phase < duty_cycle)
+
+
+@functools.lru_cache(maxsize=64)
+def _square_period(frequency: int, duty_cycle: float, volume: float, sample_rate: int) -> np.ndarray:
+    """Renders the shortest stretch of square wave that repeats exactly, for tiling by render_tone"""
+    template = np.empty(sample_rate // math.gcd(frequency, sample_rate), dtype=np.float32)
+    _square_wave(frequency, duty_cycle, volume, sample_rate, out=template)
+    template.flags.writeable = False  # Shared between calls through the cache
+    return template
+
+
+def _tone_buffer(num_samples: int) -> np.ndarray:
+    """Returns a view of the shared tone buffer, growing it if a note is longer than any before"""
+    global _TONE_BUF
+    if num_samples > _TONE_BUF.size:
+        _TONE_BUF = np.empty(num_samples, dtype=np.float32)
+    return _TONE_BUF[:num_samples]
 
 
 def midi_note_to_frequency(midi_note: int) -> int:
-    frequency: float = 2 ** ((midi_note - 69) / 12) * 440
-    return int(frequency)
+    if 0 <= midi_note < 128:
+        return int(_MIDI_HZ[midi_note])
+    # Outside the MIDI range (e.g. after an octave shift), where the table would wrap or overflow
+    return round(2 ** ((midi_note - 69) / 12) * 440)
 
 
 def play_note(midi_note: int, duration: float):
@@ -38,74 +115,143 @@ def play_note(midi_note: int, duration: float):
     play_tone(frequency, duration)
 
 
+@functools.lru_cache(maxsize=None)
 def note_name_to_midi(note_name: str, octave_shift: int = 0) -> int:
     """
     Converts a note name (e.g., "C4") to a MIDI note number.
     """
-    notes = {'C': 0,
-             'C#': 1,
-             'Db': 1,
-             'D': 2,
-             'D#': 3,
-             'Eb': 3,
-             'E': 4,
-             'F': 5,
-             'F#': 6,
-             'Gb': 6,
-             'G': 7,
-             'G#': 8,
-             'Ab': 8,
-             'A': 9,
-             'A#': 10,
-             'Bb': 10,
-             'B': 11}
     note = note_name[:-1]
     octave = int(note_name[-1])
-    midi_note = 12 * (octave + 1 + octave_shift) + notes[note]
+    midi_note = 12 * (octave + 1 + octave_shift) + _NOTE_OFFSETS[note]
     return midi_note
 
 
-def play_melody_from_file(filename: str):
+@functools.lru_cache(maxsize=None)
+def note_name_to_frequency(note_name: str) -> int:
     """
-    Plays a melody from a text file.
+    Converts a note name (e.g., "C4") straight to its frequency in Hz, one cache hit per repeated note.
+    """
+    return midi_note_to_frequency(note_name_to_midi(note_name))
+
+
+def load_melody(filename: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Parses a melody text file into parallel arrays of frequencies (Hz, int32) and durations (s, float32).
+    Pauses are encoded as a frequency of 0, and consecutive pauses are merged into one.
     """
+    freqs: list[int] = []
+    durations: list[float] = []
     with open(filename, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
+        lines = f.read().splitlines()  # Melody files are tiny, read them in one go
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        note_or_pause, duration = line.split(':', 1)
+        durations.append(float(duration))
+
+        if note_or_pause.startswith('P'):
+            freqs.append(0)
+        else:
+            freqs.append(note_name_to_frequency(note_or_pause))
+    return coalesce_pauses(np.array(freqs, dtype=np.int32), np.array(durations, dtype=np.float32))
+
+
+def coalesce_pauses(freqs: np.ndarray, durations: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Merges each run of consecutive pauses (frequency 0) into a single pause of their total duration,
+    so playback sleeps once per silent stretch.
+    """
+    pause = freqs == 0
+    starts = np.ones(freqs.size, dtype=bool)  # Events that don't continue a run of pauses
+    starts[1:] = ~(pause[1:] & pause[:-1])
+    groups = np.cumsum(starts) - 1
+    merged = np.bincount(groups, weights=durations, minlength=int(starts.sum()))
+    return freqs[starts], merged.astype(np.float32)
 
-            parts = line.split(':')
-            note_or_pause = parts[0]
-            duration = float(parts[1])
-            logging.info(f"Note: {note_or_pause}")
 
-            if note_or_pause.startswith('P'):
-                sd.sleep(int(duration * 1000))  # Pause in milliseconds
-            elif note_or_pause.startswith('#'):
+def play_melody_from_file(filename: str, duty_cycle=0.05, volume=0.2, sample_rate=44100):
+    """
+    Plays a melody from a text file.
+    Notes are rendered up to 4 ahead while an audio stream plays them back to back,
+    so synthesis overlaps playback and there are no gaps between notes.
+    """
+    import sounddevice as sd  # Only the speaker paths need the audio stack
+
+    freqs, durations = load_melody(filename)
+    chunks: queue.Queue = queue.Queue(maxsize=4)
+    finished = threading.Event()
+    completed = False
+    current = np.empty(0, dtype=np.float32)
+    position = 0
+
+    def callback(outdata, frames, time_info, status):
+        nonlocal current, position, completed
+        filled = 0
+        while filled < frames:
+            if position == current.size:
+                try:
+                    chunk = chunks.get_nowait()
+                except queue.Empty:  # Renderer fell behind, pad with silence
+                    outdata[filled:, 0] = 0
+                    return
+                if chunk is None:  # End of melody
+                    outdata[filled:, 0] = 0
+                    completed = True
+                    raise sd.CallbackStop
+                current, position = chunk, 0
+            n = min(frames - filled, current.size - position)
+            outdata[filled:filled + n, 0] = current[position:position + n]
+            filled += n
+            position += n
+
+    def put(chunk: np.ndarray | None) -> bool:
+        """Queues a chunk for the callback, giving up once the stream has stopped"""
+        while not finished.is_set():
+            try:
+                chunks.put(chunk, timeout=0.1)
+                return True
+            except queue.Full:
                 continue
+        return False
+
+    with sd.OutputStream(samplerate=sample_rate, channels=1, dtype='float32', callback=callback,
+                         finished_callback=finished.set):
+        for freq, duration in zip(freqs.tolist(), durations.tolist()):
+            if freq == 0:
+                _log.info("Pause: %gs", duration)
+                chunk = np.zeros(int(duration * sample_rate), dtype=np.float32)
             else:
-                midi_note = note_name_to_midi(note_or_pause)
-                play_note(midi_note, duration)
+                _log.info("Note: %dHz", freq)
+                chunk = render_tone(freq, duration, duty_cycle, volume, sample_rate)
+            if not put(chunk):
+                break
+        else:
+            # Nothing left to render, so the whole melody plus some slack bounds the wait
+            if put(None):
+                finished.wait(timeout=float(durations.sum()) + 1.0)
+    if not completed:
+        raise RuntimeError(f"Audio stream stopped before the end of '{filename}'")
 
 
 def preview_midi_tracks(midi_file: str):
     """
     Previews the tracks in a MIDI file, including their names and events.
     """
+    import mido  # Only needed here, so .txt playback doesn't pay for importing it
+
     mid = mido.MidiFile(midi_file)
 
     for i, track in enumerate(mid.tracks):
-        track_name = f'Track {i + 1}'
         if len(track) < 10:
             continue
-        for msg in track:
-            if msg.type == 'track_name':
-                track_name = msg.name
-                break  # Track name found, no need to look further
+        # The name is a meta message at the start of the track, so don't scan unnamed tracks to the end
+        track_name = next((msg.name for msg in itertools.islice(track, 32) if msg.type == 'track_name'),
+                          f'Track {i + 1}')
 
         print(f'{track_name}:')
-        for msg in track[:10]:  # Preview the first 5 events
+        for msg in track[:10]:  # Preview the first 10 events
             print(f'  {msg}')
         if len(track) > 10:
             print("  ...")
@@ -118,31 +264,32 @@ def play_file_on_function_gen(filename: str, device: fg.Device):
     """
     Plays a melody from a text file to a function generator.
     """
+    freqs, durations = load_melody(filename)  # Parse up front, keeping file I/O out of the playback loop
     with fg.VISA_Connection(device) as visa:
         function_generator = fg.Function_Gen(visa, offset=1.15, vpp=2.3, pulse_width=186e-6)
         # function_generator = fg.Function_Gen(visa, offset=2.5, vpp=5, pulse_width=186e-6)
-        with open(filename, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-
-                parts = line.split(':')
-                note_or_pause = parts[0]
-                duration = float(parts[1])
-
-                if note_or_pause.startswith('P'):
-                    logging.info(f"Sleeping for {duration}s.")
-                    sd.sleep(int(duration * 1000))  # Pause in milliseconds
-                elif note_or_pause.startswith('#'):
-                    continue
-                else:
-                    midi_note = note_name_to_midi(note_or_pause, 0)
-                    freq = midi_note_to_frequency(midi_note)
-                    # play_note(midi_note, duration)
-                    logging.info(f"Playing tone {freq:.3e}Hz ({note_or_pause}) for {duration}s.")
-                    function_generator.play_tone(freq, duration)
-                    logging.info("Tone playing complete")
+        events = list(zip(freqs.tolist(), durations.tolist()))
+        # Sleep to absolute deadlines, so write latency doesn't accumulate into the melody's length
+        ends = np.cumsum(durations, dtype=np.float64).tolist()
+        t0 = perf_counter()
+        if events and events[0][0]:
+            function_generator.begin_tone(events[0][0])
+        for i, (freq, duration) in enumerate(events):
+            if freq == 0:
+                _log.info("Sleeping for %gs.", duration)
+            else:
+                _log.info("Playing tone %.3eHz for %gs.", freq, duration)
+            deadline = t0 + ends[i]
+            # Queue the next event's write PIPELINE_SLACK early, so it lands on the beat
+            sleep(max(0.0, deadline - PIPELINE_SLACK - perf_counter()))
+            next_freq = events[i + 1][0] if i + 1 < len(events) else 0
+            if next_freq:
+                if next_freq == freq:
+                    function_generator.end_tone()  # Re-articulate a repeated note, or the two merge into one
+                function_generator.begin_tone(next_freq)
+            elif freq:
+                function_generator.end_tone()
+            sleep(max(0.0, deadline - perf_counter()))
         function_generator.stop()
 
 
@@ -150,9 +297,9 @@ if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
     devices = fg.scan_visa()
     if devices:
-        print("Available Devices:")
+        _log.info("Available Devices:")
         for device in devices:
-            print(device)
+            _log.info("%s", device)
 
         # play_file_on_function_gen("Melodies/StairwayToHeaven.txt", fg.Device(devices[0]))
         play_file_on_function_gen("Melodies/MoneyForNothing.txt", fg.Device(devices[0]))
@@ -160,14 +307,14 @@ if __name__ == '__main__':
         # play_file_on_function_gen("Melodies/DaftPunk-HarderBetterFasterStronger.txt", fg.Device(devices[0]))
         # play_file_on_function_gen("Melodies/BeverlyHillsCopThemeSong.txt", fg.Device(devices[0]))
     else:
-        print("No available devices found.")
-
+        _log.warning("No available devices found.")
 
-# play_melody_from_file("Melodies/Ode.txt")
-# play_melody_from_file("Melodies/DaftPunk-HarderBetterFasterStronger.txt")
-# play_melody_from_file("Melodies/BeverlyHillsCopThemeSong.txt")
-# play_melody_from_file("Melodies/Twinkle.txt")
-# play_melody_from_file("Melodies/Test Melody.txt")
+    # Examples kept under the main guard, so un-commenting one never runs it on import
+    # play_melody_from_file("Melodies/Ode.txt")
+    # play_melody_from_file("Melodies/DaftPunk-HarderBetterFasterStronger.txt")
+    # play_melody_from_file("Melodies/BeverlyHillsCopThemeSong.txt")
+    # play_melody_from_file("Melodies/Twinkle.txt")
+    # play_melody_from_file("Melodies/Test Melody.txt")
 
-# Example usage: Preview the tracks in "twinkle.mid"
-# preview_midi_tracks('Melodies/BeverlyHillsCopThemeSong.mid')
+    # Example usage: Preview the tracks in "twinkle.mid"
+    # preview_midi_tracks('Melodies/BeverlyHillsCopThemeSong.mid')